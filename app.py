@@ -1,9 +1,17 @@
+from __future__ import annotations
+
 import re
 import io
-import pdfplumber
-import pandas as pd
 import streamlit as st
-from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import TYPE_CHECKING
+
+# pandas e pdfplumber são importados dentro das funções que os usam, para não
+# atrasar a primeira renderização da interface
+if TYPE_CHECKING:
+    import pandas as pd
 
 # Colunas fixas solicitadas
 COLUMNS = [
@@ -26,121 +34,175 @@ COLUMNS = [
     "valor_recebimento",
 ]
 
-
-def parse_br_number(value):
-    """Converte números no padrão brasileiro (5.458,96) para float."""
-    if value is None:
-        return None
-    text = str(value).strip()
-    if not text:
-        return None
-    normalized = text.replace(".", "").replace(",", ".")
-    try:
-        return float(normalized)
-    except ValueError:
-        return None
+# Colunas extraídas como texto no padrão brasileiro e convertidas para float no DataFrame
+NUMERIC_COLUMNS = ["peso_pedido", "total_nota", "valor_recebimento"]
+
+# Padrões de cabeçalho do romaneio (valem para todas as notas)
+# [^\S\n] = espaço em branco sem quebra de linha, para a rota não atravessar linhas
+_ROTA_RE = re.compile(r"^[^\S\n]*(\d{2,4}[^\S\n]+[A-Za-zÀ-ÿ0-9 .,\-()]+?)[^\S\n]*$", re.MULTILINE)
+# Cada campo fica dentro de um lookahead para que uma única varredura encontre
+# todos eles, inclusive quando se sobrepõem (ex.: "Carga" dentro de "Peso Carga").
+_HEADER_RE = re.compile(
+    r"(?=Emiss[aã]o:\s*(?P<data_emissao>[\d/]{8,10}))"
+    r"|(?=Previs[aã]o:\s*(?P<data_previsao>[\d/]{8,10}))"
+    r"|(?=Motorista:\s*(?P<motorista>[^\n]+))"
+    r"|(?=Peso\s*Carga[:\s]+(?P<peso_carga>[0-9\.,]+))"
+    r"|(?=Ve[ií]culo:\s*(?P<veiculo>[^\n]+))"
+    r"|(?=Carga[:\s]+(?P<carga>[0-9\.,]+))",
+    re.IGNORECASE,
+)
+_PESO_CARGA = re.compile(r"Peso\s*Carga[:\s]+([0-9\.,]+)", re.IGNORECASE)
+
+# Delimitadores de blocos de notas
+_NOTE_PATTERN = re.compile(r"(?:^|\n)\s*(\d{3,5}-\d{3,})")
+_PEDIDO_SPLIT = re.compile(r"(?:^|\n)\s*(Pedido:\s*\d+)")
+
+# Campos de cada bloco de nota
+_NOME_LINE = re.compile(r"Nome:\s*([^\n]+)", re.IGNORECASE)
+_CODE_MATCH = re.compile(r"(\d+)\s*-\s*(.+)")
+_CIDADE_SUFFIX = re.compile(r"\s*Cidade:\s*.*$", re.IGNORECASE)
+_PEDIDO = re.compile(r"Pedido:\s*([^\n]+)", re.IGNORECASE)
+_CIDADE = re.compile(r"Cidade:\s*([^\n]+)", re.IGNORECASE)
+_PESO_PEDIDO = re.compile(r"Peso\s*Pedido:\s*([0-9\.,]+)", re.IGNORECASE)
+_ENDERECO = re.compile(r"Endere[cç]o:\s*([^\n]+)", re.IGNORECASE)
+_TOTAL_NOTA = re.compile(r"Total\s+da\s+Nota:\s*R?\$?\s*([0-9\.,]+)", re.IGNORECASE)
+_DUP_PATTERN = re.compile(
+    r"Duplicata\s+a\s+Receber\s*(.*?)\s*Valor:\s*R?\$?\s*([0-9\.,]+)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Nome de arquivo do Excel gerado
+_FILESAFE_RE = re.compile(r"[^A-Za-z0-9\-]+")
+
+
+def parse_br_numbers(series: pd.Series) -> pd.Series:
+    """Converte uma coluna de números no padrão brasileiro (5.458,96) para float."""
+    import pandas as pd
+
+    normalized = series.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    return pd.to_numeric(normalized, errors="coerce")
+
+
+def find_group(pattern: re.Pattern, text: str) -> str:
+    """Retorna o primeiro grupo capturado pelo padrão compilado, ou vazio."""
+    match = pattern.search(text)
+    return match.group(1).strip() if match else ""
 
 
 def extract_header_fields(text: str) -> dict:
     """Extrai campos gerais do romaneio que valem para todas as notas."""
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    rota = ""
-    for line in lines:
-        # Procura primeira linha com número + nome de rota (ex.: "600 PEDRO LEOPOLDO")
-        if re.match(r"^\d{2,4}\s+[A-Za-zÀ-ÿ0-9 .,\-()]+$", line):
-            rota = line
-            break
-
-    def find(pattern):
-        match = re.search(pattern, text, re.IGNORECASE)
-        return match.group(1).strip() if match else ""
-
-    data_emissao = find(r"Emiss[aã]o:\s*([\d/]{8,10})")
-    data_previsao = find(r"Previs[aã]o:\s*([\d/]{8,10})")
-    motorista_raw = find(r"Motorista:\s*([^\n]+)")
-    peso_carga = find(r"Peso\s*Carga[:\s]+([0-9\.,]+)")
-    veiculo = find(r"Ve[ií]culo:\s*([^\n]+)")
-    carga = find(r"Carga[:\s]+([0-9\.,]+)")
+    # Procura primeira linha com número + nome de rota (ex.: "600 PEDRO LEOPOLDO")
+    rota = find_group(_ROTA_RE, text)
+
+    # Guarda só a primeira ocorrência de cada campo, como um re.search por campo
+    fields = {}
+    for match in _HEADER_RE.finditer(text):
+        name = match.lastgroup
+        if name not in fields:
+            fields[name] = match.group(name).strip()
+            if len(fields) == len(_HEADER_RE.groupindex):
+                break
+
+    motorista_raw = fields.get("motorista", "")
+    peso_carga = fields.get("peso_carga", "")
 
     # Se o peso estiver junto na linha do motorista, separa
     if motorista_raw:
-        peso_inline = re.search(r"Peso\s*Carga[:\s]+([0-9\.,]+)", motorista_raw, re.IGNORECASE)
+        peso_inline = find_group(_PESO_CARGA, motorista_raw)
         if peso_inline and not peso_carga:
-            peso_carga = peso_inline.group(1).strip()
-        motorista_raw = re.sub(r"Peso\s*Carga[:\s]+[0-9\.,]+", "", motorista_raw, flags=re.IGNORECASE).strip(" -")
+            peso_carga = peso_inline
+        motorista_raw = _PESO_CARGA.sub("", motorista_raw).strip(" -")
 
     return {
         "rota": rota,
-        "data_emissao": data_emissao,
-        "data_previsao": data_previsao,
+        "data_emissao": fields.get("data_emissao", ""),
+        "data_previsao": fields.get("data_previsao", ""),
         "motorista": motorista_raw,
-        "veiculo": veiculo,
-        "carga": carga,
+        "veiculo": fields.get("veiculo", ""),
+        "carga": fields.get("carga", ""),
         "peso_carga": peso_carga,
     }
 
 
 def split_notes_blocks(text: str) -> list:
-    """Divide o texto bruto em blocos de notas identificando possíveis números de nota."""
+    """Divide o texto bruto em pares (numero_nota, bloco) identificando possíveis números de nota."""
     # Primeiro tenta o padrão mais comum (ex.: 1552-24995 ou 748-12263)
-    note_pattern = re.compile(r"(?:^|\n)\s*(\d{3,5}-\d{3,})")
-    positions = [m.start(1) for m in note_pattern.finditer(text)]
+    # parts = [antes da 1ª nota, delimitador, corpo, delimitador, corpo, ...]
+    parts = _NOTE_PATTERN.split(text)
+    if len(parts) > 1:
+        return [(numero, (numero + body).strip()) for numero, body in zip(parts[1::2], parts[2::2])]
+
+    # Se não achar nada, tenta usar "Pedido:" como delimitador (blocos sem número de nota)
+    parts = _PEDIDO_SPLIT.split(text)
+    return [("", (pedido + body).strip()) for pedido, body in zip(parts[1::2], parts[2::2])]
+
+
+def iter_notes_blocks(pages):
+    """Gera pares (numero_nota, bloco) página a página, sem juntar o PDF inteiro."""
+    # Cada página só é dividida uma vez; o bloco ainda aberto no fim de uma página
+    # é guardado em pedaços e recebe o texto da seguinte até o próximo delimitador
+    pending_pages = []
+    carry_numero, carry_parts = None, []
+    for page_index, page_text in enumerate(pages):
+        # Mesmo "\n" que o "\n".join das páginas colocaria entre elas
+        text = f"\n{page_text}" if page_index else page_text
+        parts = _NOTE_PATTERN.split(text)
+        if len(parts) == 1:
+            if carry_numero is None:
+                pending_pages.append(page_text)
+            else:
+                carry_parts.append(text)
+            continue
 
-    # Se não achar nada, tenta usar "Pedido:" como delimitador de blocos
-    if not positions:
-        pedido_pattern = re.compile(r"(?:^|\n)\s*Pedido:\s*\d+")
-        positions = [m.start() for m in pedido_pattern.finditer(text)]
+        if carry_numero is None:
+            # Descarta o cabeçalho antes da primeira nota
+            pending_pages = []
+        else:
+            carry_parts.append(parts[0])
+            yield carry_numero, "".join(carry_parts).strip()
 
-    if not positions:
-        return []
+        for numero, body in zip(parts[1:-2:2], parts[2:-2:2]):
+            yield numero, (numero + body).strip()
+        carry_numero, carry_parts = parts[-2], [parts[-2], parts[-1]]
 
-    blocks = []
-    for idx, start in enumerate(positions):
-        end = positions[idx + 1] if idx + 1 < len(positions) else len(text)
-        blocks.append(text[start:end].strip())
-    return blocks
+    if carry_numero is not None:
+        yield carry_numero, "".join(carry_parts).strip()
+    else:
+        # Sem números de nota, usa "Pedido:" como delimitador sobre o texto todo
+        yield from split_notes_blocks("\n".join(pending_pages))
 
 
-def parse_block(block: str, header: dict) -> dict:
+def parse_block(numero_nota: str, block: str, header: dict) -> dict:
     """Extrai campos de um bloco individual de nota."""
 
-    def find(pattern):
-        match = re.search(pattern, block, re.IGNORECASE)
-        return match.group(1).strip() if match else ""
-
     def clean_nome(value: str) -> str:
         if not value:
             return ""
         # Remove parte de cidade colada ao nome (ex.: "Nome Cliente Cidade: DIVINÓPOLIS")
-        return re.sub(r"\s*Cidade:\s*.*$", "", value, flags=re.IGNORECASE).strip(" -")
-
-    numero_nota = find(r"^\s*(\d{3,5}-\d+)")
+        return _CIDADE_SUFFIX.sub("", value).strip(" -")
 
-    nome_line = find(r"Nome:\s*([^\n]+)")
+    nome_line = find_group(_NOME_LINE, block)
     codigo_cliente, nome_cliente = "", ""
     if nome_line:
-        code_match = re.match(r"(\d+)\s*-\s*(.+)", nome_line)
+        code_match = _CODE_MATCH.match(nome_line)
         if code_match:
             codigo_cliente = code_match.group(1).strip()
             nome_cliente = clean_nome(code_match.group(2).strip())
         else:
             nome_cliente = clean_nome(nome_line)
 
-    pedido = find(r"Pedido:\s*([^\n]+)")
-    cidade = find(r"Cidade:\s*([^\n]+)")
-    peso_pedido = parse_br_number(find(r"Peso\s*Pedido:\s*([0-9\.,]+)"))
-    endereco = find(r"Endere[cç]o:\s*([^\n]+)")
-    total_nota = parse_br_number(find(r"Total\s+da\s+Nota:\s*R?\$?\s*([0-9\.,]+)"))
+    pedido = find_group(_PEDIDO, block)
+    cidade = find_group(_CIDADE, block)
+    # Valores numéricos ficam como texto; parse_br_numbers converte a coluna inteira depois
+    peso_pedido = find_group(_PESO_PEDIDO, block) or None
+    endereco = find_group(_ENDERECO, block)
+    total_nota = find_group(_TOTAL_NOTA, block) or None
 
     forma_recebimento, valor_recebimento = "", None
-    dup_match = re.search(
-        r"Duplicata\s+a\s+Receber\s*(.*?)\s*Valor:\s*R?\$?\s*([0-9\.,]+)",
-        block,
-        re.IGNORECASE | re.DOTALL,
-    )
+    dup_match = _DUP_PATTERN.search(block)
     if dup_match:
         forma_recebimento = dup_match.group(1).strip()
-        valor_recebimento = parse_br_number(dup_match.group(2))
+        valor_recebimento = dup_match.group(2).strip() or None
 
     record = {
         **header,
@@ -164,42 +226,90 @@ def parse_block(block: str, header: dict) -> dict:
     return record
 
 
+def parse_pages_to_records(pages):
+    """Recebe o texto de cada página do PDF e gera os dicionários das notas."""
+    pages = iter(pages)
+    # O cabeçalho do romaneio fica na primeira página
+    first_page = next(pages, None)
+    if first_page is None:
+        return
+    header = extract_header_fields(first_page)
+
+    for numero_nota, block in iter_notes_blocks(chain([first_page], pages)):
+        yield parse_block(numero_nota, block, header)
+
+
 def parse_text_to_records(text: str) -> list:
     """Recebe texto bruto do PDF e devolve lista de dicionários das notas."""
-    header = extract_header_fields(text)
-    blocks = split_notes_blocks(text)
-    records = []
+    return list(parse_pages_to_records([text]))
 
-    for block in blocks:
-        records.append(parse_block(block, header))
 
-    return records
+def parse_pdf_records(file) -> list:
+    """Abre um PDF, lê o texto página a página e retorna os registros das notas."""
+    import pdfplumber
+
+    with pdfplumber.open(file) as pdf:
+        pages = (page.extract_text() or "" for page in pdf.pages)
+        return list(parse_pages_to_records(pages))
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def parse_pdf_bytes(file_bytes: bytes) -> list:
+    """Processa o conteúdo de um PDF, reaproveitando o resultado de arquivos já processados."""
+    return parse_pdf_records(io.BytesIO(file_bytes))
+
+
+def parse_uploaded_file(file_name: str, file_bytes: bytes) -> tuple:
+    """Processa um arquivo enviado e devolve (nome, registros ou exceção)."""
+    # Roda em threads de trabalho: o erro volta para ser exibido em main
+    try:
+        return file_name, parse_pdf_bytes(file_bytes)
+    except Exception as exc:
+        return file_name, exc
 
 
 def parse_pdf(file) -> pd.DataFrame:
-    """Abre um PDF, concatena o texto das páginas e retorna DataFrame das notas."""
-    full_text_parts = []
-    with pdfplumber.open(file) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text() or ""
-            full_text_parts.append(page_text)
-    full_text = "\n".join(full_text_parts)
+    """Abre um PDF e retorna DataFrame das notas."""
+    import pandas as pd
 
-    records = parse_text_to_records(full_text)
-    df = pd.DataFrame(records, columns=COLUMNS)
+    df = pd.DataFrame(parse_pdf_records(file), columns=COLUMNS)
+    for column in NUMERIC_COLUMNS:
+        df[column] = parse_br_numbers(df[column])
     return df
 
 
-def format_date_br(date_str: str) -> str:
-    """Normaliza datas dd/mm/yyyy ou dd/mm/yy (opcional)."""
-    if not date_str:
-        return ""
-    for fmt in ("%d/%m/%Y", "%d/%m/%y"):
-        try:
-            return datetime.strptime(date_str, fmt).strftime("%d/%m/%Y")
-        except ValueError:
-            continue
-    return date_str.strip()
+def normalize_date_series(series: pd.Series) -> pd.Series:
+    """Normaliza uma coluna de datas dd/mm/yyyy ou dd/mm/yy (opcional) para dd/mm/yyyy."""
+    import pandas as pd
+
+    text = series.fillna("").astype(str).str.strip()
+    parsed = pd.to_datetime(text, format="%d/%m/%Y", errors="coerce")
+    # Datas com ano de dois dígitos (dd/mm/yy) ficam para uma segunda passada
+    mask = parsed.isna() & text.ne("")
+    if mask.any():
+        parsed.loc[mask] = pd.to_datetime(text[mask], format="%d/%m/%y", errors="coerce")
+    return parsed.dt.strftime("%d/%m/%Y").fillna(text)
+
+
+def build_excel(df: pd.DataFrame) -> io.BytesIO:
+    """Gera o Excel em memória com o xlsxwriter em modo constant_memory."""
+    import pandas as pd
+
+    buffer = io.BytesIO()
+    # constant_memory só mantém a linha atual na memória, mas to_excel grava coluna
+    # por coluna e perderia células: por isso as linhas são escritas em ordem aqui
+    with pd.ExcelWriter(
+        buffer, engine="xlsxwriter", engine_kwargs={"options": {"constant_memory": True}}
+    ) as writer:
+        worksheet = writer.book.add_worksheet("Romaneio")
+        header_format = writer.book.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+        worksheet.write_row(0, 0, df.columns, header_format)
+
+        # NaN vira célula vazia (v != v só é verdadeiro para NaN), sem copiar o DataFrame
+        for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_idx, 0, [None if value != value else value for value in row])
+    buffer.seek(0)
+    return buffer
 
 
 def main():
@@ -217,45 +327,56 @@ def main():
         st.info("Aguardando arquivos PDF para processar.")
         return
 
-    dataframes = []
-    for uploaded_file in uploaded_files:
-        try:
-            df_pdf = parse_pdf(uploaded_file)
-            if not df_pdf.empty:
-                # Normaliza datas para um formato único
-                df_pdf["data_emissao"] = df_pdf["data_emissao"].apply(format_date_br)
-                df_pdf["data_previsao"] = df_pdf["data_previsao"].apply(format_date_br)
-                dataframes.append(df_pdf)
-            else:
-                st.warning(f"Nenhuma nota encontrada em {uploaded_file.name}.")
-        except Exception as exc:
-            st.error(f"Erro ao processar {uploaded_file.name}: {exc}")
+    import pandas as pd
+
+    # Os PDFs são independentes entre si, então são processados em paralelo
+    file_names = [uploaded_file.name for uploaded_file in uploaded_files]
+    file_contents = [uploaded_file.getvalue() for uploaded_file in uploaded_files]
+    # As threads recebem o ScriptRunContext da execução atual, usado pelo st.cache_data
+    with ThreadPoolExecutor(
+        max_workers=min(8, len(uploaded_files)),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as executor:
+        results = list(executor.map(parse_uploaded_file, file_names, file_contents))
+
+    all_records = []
+    for file_name, result in results:
+        if isinstance(result, Exception):
+            st.error(f"Erro ao processar {file_name}: {result}")
+        elif result:
+            all_records.extend(result)
+        else:
+            st.warning(f"Nenhuma nota encontrada em {file_name}.")
 
-    if not dataframes:
+    if not all_records:
         st.warning("Nenhuma nota foi identificada nos PDFs enviados.")
         return
 
-    df_all = pd.concat(dataframes, ignore_index=True)
+    df_all = pd.DataFrame(all_records, columns=COLUMNS)
+    # Normaliza datas para um formato único
+    df_all["data_emissao"] = normalize_date_series(df_all["data_emissao"])
+    df_all["data_previsao"] = normalize_date_series(df_all["data_previsao"])
+    for column in NUMERIC_COLUMNS:
+        df_all[column] = parse_br_numbers(df_all[column])
 
     st.subheader("Notas encontradas")
     st.dataframe(df_all)
 
-    total_nota_sum = pd.to_numeric(df_all["total_nota"], errors="coerce").fillna(0).sum()
-    peso_total_sum = pd.to_numeric(df_all["peso_pedido"], errors="coerce").fillna(0).sum()
+    # As colunas já são float (parse_br_numbers); sum ignora NaN sem cópias extras
+    total_nota_sum = df_all["total_nota"].sum()
+    peso_total_sum = df_all["peso_pedido"].sum()
 
     col1, col2 = st.columns(2)
     col1.metric("Soma das Notas (R$)", f"{total_nota_sum:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
     col2.metric("Peso Total", f"{peso_total_sum:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
 
     # Gera Excel em memória para download
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        df_all.to_excel(writer, index=False, sheet_name="Romaneio")
-    buffer.seek(0)
+    buffer = build_excel(df_all)
 
     rota_name = df_all["rota"].dropna().astype(str).str.strip()
     rota_label = rota_name.iloc[0] if not rota_name.empty and rota_name.iloc[0] else "romaneio"
-    file_safe = re.sub(r"[^A-Za-z0-9\-]+", "_", rota_label).strip("_") or "romaneio"
+    file_safe = _FILESAFE_RE.sub("_", rota_label).strip("_") or "romaneio"
     download_name = f"romaneio_rota_{file_safe}.xlsx"
 
     st.download_button(